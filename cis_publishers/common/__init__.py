@@ -1,9 +1,10 @@
-from .people import change_profile, get_profile
+from .people import change_profile, get_profile, get_profiles
 from .profile import InactiveProfileException, Profile, ProfileNotFoundException
 
 __all__ = [
     "change_profile",
     "get_profile",
+    "get_profiles",
     "InactiveProfileException",
     "Profile",
     "ProfileNotFoundException"
@@ -1,88 +1,155 @@
+import concurrent.futures
 import functools
 import json
 import logging
 import requests
+import threading
+import time
 
+from copy import deepcopy
+from jose import jwt
 from os import environ
+from requests.adapters import HTTPAdapter
+from typing import Iterable, Iterator
 from urllib.parse import quote
+from urllib3.util.retry import Retry
 
 
 # Lazily load all the things
 BEARER_TOKEN = None
+BEARER_TOKEN_REFRESH_AT = float("-inf")  # time.monotonic() after which to refresh BEARER_TOKEN
 CHANGE_API_URL = None
-NULL_PROFILE = None
 OAUTH_AUDIENCE = None
 PERSON_API_URL = None
 TOKEN_ENDPOINT = None
 
-logger = logging.getLogger()
+# Person API URL templates, built once PERSON_API_URL is known
+_PRIMARY_EMAIL_URL = None
+_PRIMARY_USERNAME_URL = None
+_USER_ID_URL = None
 
+# Bearer tokens are refreshed this many seconds before they actually expire
+TOKEN_REFRESH_MARGIN = 60
 
-def __get_bearer_token():
-    global BEARER_TOKEN, CHANGE_API_URL, OAUTH_AUDIENCE, PERSON_API_URL, TOKEN_ENDPOINT
+# Bearer tokens, keyed by (client_id, audience), as (token, expires_at)
+_TOKENS = {}
+_TOKENS_LOCK = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+# How many requests publishers make to the Person and Change APIs at once
+CONCURRENCY = int(environ.get("PUBLISHER_CONCURRENCY", 32))
+
+# A single pooled session, so that we reuse connections (and their TLS handshakes) to the Person and
+# Change APIs, instead of opening a new one for every profile. The pool is sized so that every one of
+# the publisher's threads can hold a connection.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=4,
+                       pool_maxsize=CONCURRENCY,
+                       max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]))
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
 
-    if BEARER_TOKEN is not None:
-        return BEARER_TOKEN
 
+@functools.lru_cache(maxsize=1)
+def _discovery() -> dict:
     if not environ.get("IAM_DISCOVERY_URL"):
-        logging.error("IAM_DISCOVERY_URL not set")
+        logger.error("IAM_DISCOVERY_URL not set")
         raise EnvironmentError
 
-    # First, we need to retrieve the discovery URL's contents
-    discovery = requests.get(environ["IAM_DISCOVERY_URL"]).json()
+    return _SESSION.get(environ["IAM_DISCOVERY_URL"]).json()
+
+
+@functools.lru_cache(maxsize=1)
+def _token_endpoint() -> str:
+    return _SESSION.get(_discovery()["oidc_discovery_uri"]).json()["token_endpoint"]
+
+
+def _token_expires_at(response: dict) -> float:
+    """
+    :param response: the token endpoint's response
+    :return: when the bearer token expires, on the time.monotonic() clock
+    """
+    if response.get("expires_in") is not None:
+        return time.monotonic() + float(response["expires_in"])
+
+    # If the token endpoint doesn't tell us, fall back to the exp claim inside the token itself
+    exp = jwt.get_unverified_claims(response["access_token"])["exp"]
+
+    return time.monotonic() + (exp - time.time())
+
+
+def __get_bearer_token():
+    global BEARER_TOKEN, BEARER_TOKEN_REFRESH_AT, CHANGE_API_URL, OAUTH_AUDIENCE, PERSON_API_URL, TOKEN_ENDPOINT
+    global _PRIMARY_EMAIL_URL, _PRIMARY_USERNAME_URL, _USER_ID_URL
+
+    # First, we need to retrieve the discovery URL's contents (only once per process)
+    discovery = _discovery()
     CHANGE_API_URL = discovery["api"]["endpoints"]["change"]
     OAUTH_AUDIENCE = discovery["api"]["audience"]
     PERSON_API_URL = discovery["api"]["endpoints"]["person"]
-    OIDC_DISCOVERY_URL = discovery["oidc_discovery_uri"]
-    TOKEN_ENDPOINT = requests.get(OIDC_DISCOVERY_URL).json()["token_endpoint"]
+    TOKEN_ENDPOINT = _token_endpoint()
+
+    _PRIMARY_EMAIL_URL = PERSON_API_URL + "/v2/user/primary_email/{}?active=any"
+    _PRIMARY_USERNAME_URL = PERSON_API_URL + "/v2/user/primary_username/{}?active=any"
+    _USER_ID_URL = PERSON_API_URL + "/v2/user/user_id/{}?active=any"
 
-    # Then, we need to reach out to auth0 to get a bearer token
-    BEARER_TOKEN = requests.post(TOKEN_ENDPOINT, json={
-        "audience": OAUTH_AUDIENCE,
-        "client_id": environ["OAUTH_CLIENT_ID"],
-        "client_secret": environ["OAUTH_CLIENT_SECRET"],
-        "grant_type": "client_credentials",
-    }).json()["access_token"]
+    # Then, we need to reach out to auth0 to get a bearer token, unless we have one that isn't
+    # about to expire; the lock keeps all the publisher threads from refreshing it at once
+    key = (environ["OAUTH_CLIENT_ID"], OAUTH_AUDIENCE)
 
+    with _TOKENS_LOCK:
+        token, expires_at = _TOKENS.get(key, (None, 0.0))
 
-def __requires_bearer_token(func, *args, **kwargs):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        # Simply return back if there were no args or kwargs passed, so that we don't retrieve
-        # the bearer tokens if not necessary
-        if BEARER_TOKEN is None and (any(args) or any(kwargs)):
-            __get_bearer_token()
+        if time.monotonic() >= expires_at - TOKEN_REFRESH_MARGIN:
+            response = _SESSION.post(TOKEN_ENDPOINT, json={
+                "audience": OAUTH_AUDIENCE,
+                "client_id": environ["OAUTH_CLIENT_ID"],
+                "client_secret": environ["OAUTH_CLIENT_SECRET"],
+                "grant_type": "client_credentials",
+            }).json()
 
-        return func(*args, **kwargs)
+            token, expires_at = response["access_token"], _token_expires_at(response)
+            _TOKENS[key] = (token, expires_at)
 
-    return wrapper
+        BEARER_TOKEN, BEARER_TOKEN_REFRESH_AT = token, expires_at - TOKEN_REFRESH_MARGIN
+
+    return BEARER_TOKEN
+
+
+@functools.lru_cache(maxsize=1)
+def _null_profile() -> dict:
+    # Only fetched once per process (or warm Lambda container); callers get copies of it
+    return _SESSION.get(environ["CIS_NULL_PROFILE_URL"]).json()
+
+
+def _ensure_token():
+    # This is on the path of every Person and Change API call, so keep it to a single comparison
+    if time.monotonic() >= BEARER_TOKEN_REFRESH_AT:
+        __get_bearer_token()
 
 
 # TODO: should it return a skeleton profile? or should that be another function call?
-@__requires_bearer_token
 def get_profile(email: str = None, user_id: str = None, username: str = None):
-    global NULL_PROFILE
-
     if len([arg for arg in (email, user_id, username) if arg is not None]) > 1:
         raise ValueError("Cannot specify more than one of email, user_id, or username")
 
     if not any((email, user_id, username)):
-        if not NULL_PROFILE:
-            NULL_PROFILE = requests.get(environ["CIS_NULL_PROFILE_URL"]).json()
+        return deepcopy(_null_profile())
 
-        return NULL_PROFILE
+    # Only retrieve a bearer token when we actually need to talk to the Person API
+    _ensure_token()
 
-    elif email is not None:
-        url = f"{PERSON_API_URL}/v2/user/primary_email/{quote(email)}?active=any"
+    if email is not None:
+        url = _PRIMARY_EMAIL_URL.format(quote(email, safe=""))
     elif user_id is not None:
-        url = f"{PERSON_API_URL}/v2/user/user_id/{quote(user_id)}?active=any"
+        url = _USER_ID_URL.format(quote(user_id, safe=""))
     elif username is not None:
-        url = f"{PERSON_API_URL}/v2/user/primary_username/{quote(username)}?active=any"
+        url = _PRIMARY_USERNAME_URL.format(quote(username, safe=""))
 
-    # Now, let's connect to the Person API and retrieve the profile
-    profile = requests.get(url, headers={
-        "Authorization": f"Bearer {BEARER_TOKEN}"
-    }).json()
+    # Now, let's connect to the Person API and retrieve the profile; only the Person and Change API calls
+    # carry the bearer token, not everything else (like discovery) that goes through the session
+    profile = _SESSION.get(url, headers={"Authorization": f"Bearer {BEARER_TOKEN}"}).json()
 
     if not profile:
         from .profile import ProfileNotFoundException
@@ -95,15 +162,55 @@ def get_profile(email: str = None, user_id: str = None, username: str = None):
     return profile
 
 
-def change_profile(profile):
-    if isinstance(profile, str):
+def get_profiles(identifiers: Iterable[dict], max_workers: int = 16) -> Iterator[dict]:
+    """
+    Retrieve a batch of profiles concurrently, over the same pooled session as get_profile()
+
+    :param identifiers: keyword arguments for get_profile(), e.g. [{"email": "jdoe@mozilla.com"}, {"user_id": ...}]
+    :param max_workers: how many profiles to retrieve at once (keep it at or below the session's pool size)
+    :return: the profiles, in the same order as identifiers; raises ProfileNotFoundException when iterating
+             over a profile that couldn't be found
+    """
+    # Get the bearer token up front, instead of having every thread wait on it
+    _ensure_token()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    # map() submits everything immediately, so the pool can be shut down while we wait on the results
+    try:
+        return executor.map(lambda kwargs: get_profile(**kwargs), identifiers)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def change_profile(profile) -> bool:
+    """
+    :param profile: a Profile, a dictionary (or ProfileDict) of the raw profile, or its JSON
+    :return: whether the Change API accepted the profile
+    """
+    from .profile import Profile
+
+    _ensure_token()
+
+    # Send the JSON we already have (or can cheaply produce) instead of round-tripping it
+    # through a dictionary; we only need to look at a few of its attributes
+    headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
+
+    if isinstance(profile, Profile):
+        body = {"data": profile.json()}
+        headers["Content-Type"] = "application/json"
+        profile = profile._profile
+    elif isinstance(profile, (bytes, str)):
+        body = {"data": profile if isinstance(profile, bytes) else profile.encode("utf-8")}
+        headers["Content-Type"] = "application/json"
         profile = json.loads(profile)
-    elif isinstance(profile, dict):
-        pass
+    elif isinstance(profile, dict):  # including a ProfileDict
+        body = {"json": profile}
     else:
-        # If it's a ProfileDict, we need to serialize (with a default dict), and then back to a dictionary
-        # I know this is inefficient, but you can't easily read the values out of a ProfileDict
+        # Otherwise, we need to serialize (with a default dict), and then back to a dictionary
+        # I know this is inefficient, but you can't easily read the values out of anything else
         profile = json.loads(json.dumps(profile, default=dict))
+        body = {"json": profile}
 
     # Get the user_id from the profile
     user_id = profile["user_id"]["value"]
@@ -114,16 +221,14 @@ def change_profile(profile):
 
     url = f"{CHANGE_API_URL}/v2/user?user_id={user_id}"
 
-    r = requests.post(url, headers={
-        "Authorization": f"Bearer {BEARER_TOKEN}"
-    }, json=profile).json()
+    r = _SESSION.post(url, headers=headers, **body).json()
 
     if r.get("status_code") == 200:
-        logger.debug(f"Successfully updated LDAP profile `{user_id}`")
+        logger.debug("Successfully updated LDAP profile `%s`", user_id)
 
         return True
     else:
         error = f": [{r.get('code')}] {r.get('description')}" if "code" in r else ""
-        logger.error(f"Unable to update LDAP profile `{user_id}`{error}")
+        logger.error("Unable to update LDAP profile `%s`%s", user_id, error)
 
         return False
@@ -1,11 +1,13 @@
+import itertools
 import json
 import logging
+import orjson
 import time
 
-from collections import UserDict
+from collections import deque, UserDict
 from copy import copy
 from os import environ
-from jose import jws
+from jose import jwk, jws
 
 from cis_publishers.common import get_profile, change_profile
 
@@ -18,9 +20,61 @@ if "PUBLISHER_SIGNING_KEY" in environ:
 else:
     PUBLISHER_SIGNING_KEY = None
 
+# Parsing the JWK into an RSA key is expensive, so only do it once instead of for every signed attribute
+_SIGNING_KEY = jwk.construct(PUBLISHER_SIGNING_KEY, algorithm="RS256") if PUBLISHER_SIGNING_KEY else None
+
 DISPLAY_LEVEL = None
 
-logger = logging.getLogger()
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+# The attributes that all have to be empty for a profile to be empty, aside from usernames
+_IS_EMPTY_PATHS = (
+    ("access_information", "access_provider"),
+    ("access_information", "hris"),
+    ("access_information", "ldap"),
+    ("access_information", "mozilliansorg"),
+    ("alternative_name",),
+    ("description",),
+    ("identities", "bugzilla_mozilla_org_id"),
+    ("identities", "bugzilla_mozilla_org_primary_email"),
+    ("identities", "custom_1_primary_email"),
+    ("identities", "custom_2_primary_email"),
+    ("identities", "custom_3_primary_email"),
+    ("identities", "mozilla_ldap_id"),
+    ("identities", "mozilla_ldap_primary_email"),
+    ("identities", "mozilla_posix_id"),
+    ("identities", "mozilliansorg_id"),
+    ("languages",),
+    ("location",),
+    ("pgp_public_keys",),
+    ("phone_numbers",),
+    ("picture",),
+    ("pronouns",),
+    ("staff_information", "cost_center"),
+    ("staff_information", "director"),
+    ("staff_information", "manager"),
+    ("staff_information", "office_location"),
+    ("staff_information", "staff"),
+    ("staff_information", "team"),
+    ("staff_information", "title"),
+    ("staff_information", "worker_type"),
+    ("staff_information", "wpr_desk_number"),
+    ("ssh_public_keys",),
+    ("tags",),
+    ("timezone",),
+    ("uris",),
+)
+
+# Freelists of ProfileDict and SignableAttribute instances, refilled by Profile.release(), so that a
+# publisher going through thousands of profiles doesn't have to keep allocating new ones
+_POOL_MAXSIZE = 1024
+_PROFILE_DICT_POOL = []
+_SIGNABLE_ATTRIBUTE_POOL = []
+
+# Loads a Person API profile into a ProfileDict; generated from the first profile that gets loaded
+_LOADER = None
+
+logger = logging.getLogger(__name__)
 
 
 class InactiveProfileException(Exception):
@@ -34,22 +88,76 @@ class ProfileNotFoundException(Exception):
     """Basic exception when profile isn't found"""
 
 
-class ProfileDict(UserDict):
-    def __init__(self):
-        super().__init__()
+class _SchemaMismatch(Exception):
+    """When a profile doesn't have the same shape as the profile that the loader was generated from"""
 
-    def __getitem__(self, k):
-        return self.data[k]
+
+def _generate_loader(profile: dict):
+    """
+    Generate a function that loads a Person API profile into a ProfileDict, specialized to the shape of
+    the passed profile. Which keys are unsigned strings, which are signable attributes, and which are
+    nested dictionaries are all hard-coded, so that loading a profile is nothing but a series of stores
+    instead of the isinstance() cascade in Profile._walk().
+
+    The generated function checks that each dictionary it loads has exactly the keys it was generated
+    from, raising _SchemaMismatch if it doesn't.
+
+    :param profile: a Person API profile
+    :return: function(src, dst, parent_profile), or None if the profile can't be loaded
+    """
+    lines = ["def _load(src, dst, parent_profile):"]
+    namespace = {
+        "ProfileDict": ProfileDict,
+        "SignableAttribute": SignableAttribute,
+        "_SchemaMismatch": _SchemaMismatch,
+    }
+    counter = itertools.count(1)
+
+    nodes = [("src", "dst", profile)]
+    while nodes:
+        src, dst, node = nodes.pop()
+
+        keys = f"_keys{next(counter)}"
+        namespace[keys] = frozenset(node)
+        lines.append(f"    if {src}.keys() != {keys}: raise _SchemaMismatch")
+
+        for k, v in node.items():
+            if isinstance(v, str):
+                lines.append(f"    {dst}[{k!r}] = {src}[{k!r}]")
+            elif isinstance(v, dict) and ("value" in v or "values" in v):
+                lines.append(f"    {dst}[{k!r}] = SignableAttribute({src}[{k!r}], {k!r}, parent_profile)")
+            elif isinstance(v, dict) and v.get('metadata') is None and v.get('signature') is None:
+                n = next(counter)
+                lines.append(f"    src{n} = {src}[{k!r}]")
+                lines.append(f"    dst{n} = {dst}[{k!r}] = ProfileDict()")
+
+                nodes.append((f"src{n}", f"dst{n}", v))
+            else:
+                return None
+
+    exec("\n".join(lines), namespace)
+
+    return namespace["_load"]
+
+
+class ProfileDict(dict):
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        try:
+            return _PROFILE_DICT_POOL.pop()
+        except IndexError:
+            return super().__new__(cls)
 
     def __setitem__(self, k, v):
-        if k in self.data:
+        if k in self:
             # This makes it so setting _.profile["active"] = True actually sets the signed value to true
             # and doesn't overwrite the signed attribute itself
-            if isinstance(self.data[k], SignableAttribute):
-                self.data[k].value = v
+            if isinstance(self[k], SignableAttribute):
+                self[k].value = v
 
                 return v
-            elif isinstance(self.data[k], ProfileDict):
+            elif isinstance(self[k], ProfileDict):
                 raise ValueError("Attempted to overwrite profile dictionary with single value")
 
         else:
@@ -79,7 +187,7 @@ class Profile(UserDict):
         self._base_keys = retrieved_profile.keys()  # when calling __getitem__(), this sends you into self.data
 
         # Pushed the retrieved JSON into a Profile(), and then push that into a dictionary
-        self._walk(retrieved_profile, self._profile)
+        self._load(retrieved_profile)
         self._walk(self._profile, self.data)
 
         # We can't set active on inactive profiles unless we're the HRIS publisher
@@ -92,6 +200,14 @@ class Profile(UserDict):
         # Store a list of messages passed from SignedAttributes
         self.__notifications = []
 
+        # While signing, every modified attribute gets stamped with the same timestamp, and only
+        # gets an actual signature if we're not dry running
+        self._sign_data = True
+        self._sign_timestamp = None
+
+        # Attributes that were modified while dry running, and still need signing, keyed by id()
+        self._unsigned = {}
+
     def __getitem__(self, k):
         if k in self.data:
             return self.data[k]
@@ -106,7 +222,25 @@ class Profile(UserDict):
             setattr(self, k, v)
 
     def __str__(self):
-        return json.dumps(self.data, indent=2, sort_keys=True)
+        return orjson.dumps(self.data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode("utf-8")
+
+    def _load(self, retrieved_profile: dict):
+        """
+        Load a Person API profile into self._profile, using the generated loader whenever the profile
+        has the same shape as the first one loaded, and walking it otherwise.
+        """
+        global _LOADER
+
+        if _LOADER is None:
+            _LOADER = _generate_loader(retrieved_profile)
+
+        if _LOADER is not None:
+            try:
+                return _LOADER(retrieved_profile, self._profile, self)
+            except _SchemaMismatch:
+                self._profile = ProfileDict()
+
+        self._walk(retrieved_profile, self._profile)
 
     def _walk(self, input_node, output_node):
         """
@@ -116,49 +250,59 @@ class Profile(UserDict):
         It can convert from three different modes:
         Person API -> Internal state (ProfileDict + SignableAttribute) [self._profile] <--> Simple dict [self.data]
         """
-        for k, v in input_node.items():
-            # If it's a string, that means it's something like 'schema' that is unsigned
-            # Person API --> self._profile <--> self.data
-            if isinstance(v, str):
-                output_node[k] = v
-
-            # Synchronize values on calls to .json()
-            # self.data -> self._profile
-            elif isinstance(output_node.get(k), SignableAttribute):
-                if output_node[k].value != v:
-                    output_node[k].value = v
-
-            # If it has a value or values setting, we've gotten to an actual key -> value mapping
-            # self._profile -> self.data
-            elif isinstance(v, SignableAttribute) and "value" in v:
-                output_node[k] = v.value
-
-            # Has a value or value setting, but it's a dict, indicating that we're reducing from
-            # an initial profile (from the skeleton or people) into self._profile
-            # Person API -> self._profile
-            elif isinstance(v, dict) and ("value" in v or "values" in v):
-                output_node[k] = SignableAttribute(v, name=k, parent_profile=self)
-
-            # If it has neither metadata nor signature and is a dictionary, we need to continue
-            # traversing downward
-            # Person API -> self._profile <- self.data
-            elif isinstance(v, dict) and v.get('metadata') is None and v.get('signature') is None:
-                if k not in output_node:  # Person API -> self._profile
-                    output_node[k] = ProfileDict()
-
-                # PersonAPI -> self._profile <- self.data
-                self._walk(v, output_node[k])
-
-            # self._profile -> self.data
-            elif isinstance(v, ProfileDict):
-                output_node[k] = {}
-
-                self._walk(v, output_node[k])
-
-            # Trying to set an attribute in self.data that can't be moved into self._profile, because it doesn't
-            # exists
-            else:
-                raise ValueError(f"Attempted to set invalid attribute {k} into profile.")
+        # Bound locally, since this runs over every attribute of the profile on every load, sign, and export
+        _dict, _isinstance, _ProfileDict, _SignableAttribute = dict, isinstance, ProfileDict, SignableAttribute
+
+        # Rather than recursing, keep a stack of the (input, output) nodes that still need walking
+        stack = deque([(input_node, output_node)])
+
+        while stack:
+            input_node, output_node = stack.pop()
+
+            for k, v in input_node.items():
+                # If it's a string, that means it's something like 'schema' that is unsigned
+                # Person API --> self._profile <--> self.data
+                if type(v) is str:
+                    output_node[k] = v
+
+                # Synchronize values on calls to .json()
+                # self.data -> self._profile
+                elif _isinstance(output_node.get(k), _SignableAttribute):
+                    if output_node[k].value != v:
+                        output_node[k].value = v
+
+                # If it has a value or values setting, we've gotten to an actual key -> value mapping
+                # self._profile -> self.data
+                elif _isinstance(v, _SignableAttribute) and "value" in v:
+                    output_node[k] = v.value
+
+                # self._profile -> self.data (this needs to come before the checks for plain dictionaries,
+                # as a ProfileDict is a dictionary too)
+                elif _isinstance(v, _ProfileDict):
+                    output_node[k] = {}
+
+                    stack.append((v, output_node[k]))
+
+                # Has a value or value setting, but it's a dict, indicating that we're reducing from
+                # an initial profile (from the skeleton or people) into self._profile
+                # Person API -> self._profile
+                elif _isinstance(v, _dict) and ("value" in v or "values" in v):
+                    output_node[k] = _SignableAttribute(v, name=k, parent_profile=self)
+
+                # If it has neither metadata nor signature and is a dictionary, we need to continue
+                # traversing downward
+                # Person API -> self._profile <- self.data
+                elif _isinstance(v, _dict) and v.get('metadata') is None and v.get('signature') is None:
+                    if k not in output_node:  # Person API -> self._profile
+                        output_node[k] = _ProfileDict()
+
+                    # PersonAPI -> self._profile <- self.data
+                    stack.append((v, output_node[k]))
+
+                # Trying to set an attribute in self.data that can't be moved into self._profile, because it
+                # doesn't exists
+                else:
+                    raise ValueError(f"Attempted to set invalid attribute {k} into profile.")
 
     def is_empty(self) -> bool:
         """
@@ -166,72 +310,89 @@ class Profile(UserDict):
 
         TODO: actually use this in the inactive user cleanup process
         """
-        usernames = [] if self.data["usernames"] is None else \
-            [username for username in self.data["usernames"] if not username.startswith("HACK#")]
-
-        return not any((
-            self.data["access_information"]["access_provider"],
-            self.data["access_information"]["hris"],
-            self.data["access_information"]["ldap"],
-            self.data["access_information"]["mozilliansorg"],
-            self.data["alternative_name"],
-            self.data["description"],
-            self.data["identities"]["bugzilla_mozilla_org_id"],
-            self.data["identities"]["bugzilla_mozilla_org_primary_email"],
-            self.data["identities"]["custom_1_primary_email"],
-            self.data["identities"]["custom_2_primary_email"],
-            self.data["identities"]["custom_3_primary_email"],
-            self.data["identities"]["mozilla_ldap_id"],
-            self.data["identities"]["mozilla_ldap_primary_email"],
-            self.data["identities"]["mozilla_posix_id"],
-            self.data["identities"]["mozilliansorg_id"],
-            self.data["languages"],
-            self.data["location"],
-            self.data["pgp_public_keys"],
-            self.data["phone_numbers"],
-            self.data["picture"],
-            self.data["pronouns"],
-            self.data["staff_information"]["cost_center"],
-            self.data["staff_information"]["director"],
-            self.data["staff_information"]["manager"],
-            self.data["staff_information"]["office_location"],
-            self.data["staff_information"]["staff"],
-            self.data["staff_information"]["team"],
-            self.data["staff_information"]["title"],
-            self.data["staff_information"]["worker_type"],
-            self.data["staff_information"]["wpr_desk_number"],
-            self.data["ssh_public_keys"],
-            self.data["tags"],
-            self.data["timezone"],
-            self.data["uris"],
-            usernames,
-        ))
-
-    def json(self):
-        return json.dumps(self._profile, indent=2, default=dict)
+        for path in _IS_EMPTY_PATHS:
+            node = self.data
+            for k in path:
+                node = node[k]
+
+            if node:
+                return False
+
+        # Usernames starting with HACK# don't count
+        usernames = self.data["usernames"]
+
+        return not (usernames and any(not username.startswith("HACK#") for username in usernames))
+
+    def json(self) -> bytes:
+        """:return: the raw CIS profile, as UTF-8 encoded JSON that can be sent as-is to the Change API"""
+        return orjson.dumps(self._profile, default=dict, option=orjson.OPT_INDENT_2)
 
     def notify(self, attribute, message):
         """Used by a SignedAttribute to notify the parent profile that an attribute has changed."""
         self.__notifications.append((attribute, message))
 
     def publish(self, display_level: str = None, dry_run: bool = False):
-        self.sign(display_level)
+        """
+        Sign the profile and send it to the Change API, if anything in it has changed.
+
+        When dry running (either via dry_run or the DRY_RUN environmental variable), the changes are logged but
+        not signed, since that's wasted work; they're signed the next time the profile is published for real.
+        :return: False if the Change API rejected the profile, otherwise True
+        """
+        dry_run = dry_run or environ.get("DRY_RUN") is not None
 
-        [logger.info(f"Updating {attribute} on {self.data['user_id']} ({self.data['primary_email']}): {message}")
-         for attribute, message in sorted(self.__notifications)]
+        # If we're dry running and nobody is going to see the changes, there's nothing left to do
+        if dry_run and not logger.isEnabledFor(logging.INFO):
+            return True
+
+        self.sign(display_level, sign_data=not dry_run)
+
+        if self.__notifications and logger.isEnabledFor(logging.INFO):
+            user_id, email = self.data["user_id"], self.data["primary_email"]
+
+            for attribute, message in sorted(self.__notifications):
+                logger.info("Updating %s on %s (%s): %s", attribute, user_id, email, message)
 
         # Only publish the profile if there has been a change to it
         # And if we're not in dry_run mode
-        if self.__notifications and not dry_run and environ.get("DRY_RUN") is None:
-            change_profile(self.json())
+        if self.__notifications and not dry_run:
+            return change_profile(self)
         elif not self.__notifications:
-            logger.debug(f"Skipping publication of {self.data['primary_email']} (no changes)")
+            logger.debug("Skipping publication of %s (no changes)", self.data['primary_email'])
+
+        return True
+
+    def release(self):
+        """
+        Hand this profile's ProfileDict and SignableAttribute instances back to be reused by later profiles.
+        The profile can't be signed, published, or exported to JSON afterwards.
+        :return: None
+        """
+        stack = [self._profile]
+
+        while stack:
+            node = stack.pop()
+
+            for v in node.values():
+                if isinstance(v, SignableAttribute):
+                    v._release()
+                elif isinstance(v, ProfileDict):
+                    stack.append(v)
+
+            node.clear()
+
+            if len(_PROFILE_DICT_POOL) < _POOL_MAXSIZE:
+                _PROFILE_DICT_POOL.append(node)
+
+        self._profile = None
+        self._unsigned.clear()
 
         return None
 
-    def sign(self, display_level: str = None):
+    def sign(self, display_level: str = None, sign_data: bool = True):
         """
-        Sign all modified Profile attributes.
+        Sign all modified Profile attributes, as well as any that were modified (but not signed) while dry running.
+        :param sign_data: whether to actually generate signatures, or to just update the modified attributes
         :return: None
         """
         if display_level is not None:
@@ -239,12 +400,31 @@ class Profile(UserDict):
 
             DISPLAY_LEVEL = display_level
 
-        self._walk(self.data, self._profile)
+        self._sign_data = sign_data
+        self._sign_timestamp = time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+
+        try:
+            self._walk(self.data, self._profile)
+
+            if sign_data:
+                for attribute in list(self._unsigned.values()):
+                    attribute._sign()
+        finally:
+            self._sign_data = True
+            self._sign_timestamp = None
 
         return None
 
 
-class SignableAttribute(UserDict):
+class SignableAttribute(dict):
+    __slots__ = ("__name", "__parent_profile")
+
+    def __new__(cls, *args, **kwargs):
+        try:
+            return _SIGNABLE_ATTRIBUTE_POOL.pop()
+        except IndexError:
+            return super().__new__(cls)
+
     def __init__(self, attribute, name, parent_profile):
         super().__init__(attribute)
         self.__name = name
@@ -252,15 +432,15 @@ class SignableAttribute(UserDict):
 
     # abstract away having to know the difference between value and values
     def __contains__(self, k):
-        if k in ("value", "values") and ("value" in self.data or "values" in self.data):
+        if k in ("value", "values") and (super().__contains__("value") or super().__contains__("values")):
             return True
 
-        super().__contains__(self, k)
+        return super().__contains__(k)
 
     # abstract away having to know the difference between "value" and "values"
     def __getattr__(self, k):
         if k in ("value", "values"):
-            return self.data.get("value", self.data.get("values"))
+            return self.get("value", self.get("values"))
         elif k.startswith("_"):
             return super().__getattribute__(k)
 
@@ -272,72 +452,59 @@ class SignableAttribute(UserDict):
     def __setattr__(self, k, v):
         # CIS doesn't actually deal in arrays, they are always dictionaries with each value set to null
         if isinstance(v, list) and v:
-            v = {v: None for v in sorted(v)}
+            v = dict.fromkeys(sorted(v))
 
         # Similarly, it doesn't handle numbers either: only strings - not isinstance() since bool is an int
         if type(v) in (int, float):
             v = str(v)
 
         if k in ("value", "values"):
-            key = "value" if "value" in self.data else "values"
+            key = "value" if super().__contains__("value") else "values"
 
             # If we try to set the value to the existing value, do nothing
             # Same thing if it's currently None and we set it to None, [], or {}
-            if self.data[key] == v or (self.data[key] is None and v in (None, [], {})):
+            if self[key] == v or (self[key] is None and v in (None, [], {})):
                 return v
             else:
-                # Used for passing upward to the parent profile
-                initial_value = copy(self.data[key])
+                # Used for passing upward to the parent profile; only dictionaries need copying, as
+                # strings, booleans, and None can't change out from under us
+                initial_value = self[key]
+                if isinstance(initial_value, dict):
+                    initial_value = copy(initial_value)
 
-                self.data[key] = v
+                self[key] = v
 
             # No need to sign things that don't have a signature (this shouldn't happen)
-            if "signature" not in self.data:
+            if not super().__contains__("signature"):
                 return v
 
             # Update the creation and modified times
-            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
-            if self.data["metadata"]["created"][0:4] == "1970":
-                self.data["metadata"]["created"] = timestamp
-            self.data["metadata"]["last_modified"] = timestamp
+            timestamp = getattr(self.__parent_profile, "_sign_timestamp", None) or \
+                time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+            if self["metadata"]["created"][0:4] == "1970":
+                self["metadata"]["created"] = timestamp
+            self["metadata"]["last_modified"] = timestamp
 
             # if the display level hasn't already been set, set it to the global value
-            if self.data["metadata"]["display"] is None and DISPLAY_LEVEL is not None:
-                self.data["metadata"]["display"] = DISPLAY_LEVEL
-            elif self.data["metadata"]["display"] is None and DISPLAY_LEVEL is None:
+            if self["metadata"]["display"] is None and DISPLAY_LEVEL is not None:
+                self["metadata"]["display"] = DISPLAY_LEVEL
+            elif self["metadata"]["display"] is None and DISPLAY_LEVEL is None:
                 raise ValueError("Attempted to sign attribute without selecting display level")
 
-            # Now let's actually sign things I guess. ¯\_(ツ)_/¯
-            if PUBLISHER_SIGNING_KEY is None:
-                raise RuntimeError("Unable to load signing key")
-
-            del self.data["signature"]
-            self.data["signature"] = {
-                "additional": [{
-                    "alg": "RS256",
-                    "name": None,
-                    "typ": "JWS",
-                    "value": "",
-                }],
-                "publisher": {
-                    "alg": "RS256",
-                    "name": environ["PUBLISHER_NAME"],
-                    "typ": "JWS",
-                    "value": jws.sign(self.data, PUBLISHER_SIGNING_KEY, algorithm="RS256"),
-                }
-            }
+            # Now let's actually sign things I guess (unless we're dry running, in which case the
+            # profile hangs on to us until it's signed for real). ¯\_(ツ)_/¯
+            if getattr(self.__parent_profile, "_sign_data", True):
+                self._sign()
+            else:
+                self.__parent_profile._unsigned[id(self)] = self
 
             # Tell the parent profile that this attribute has changed, making it nice for lists
             # There is probably a better way of doing this
             if self._is_list(initial_value) and self._is_list(v):
-                adding = sorted(set(v.keys()).difference(set(initial_value.keys())))
-                deleting = sorted(set(initial_value.keys()).difference(set(v.keys())))
+                changes = [f"+{i}" for i in sorted(v.keys() - initial_value.keys())] + \
+                          [f"-{i}" for i in sorted(initial_value.keys() - v.keys())]
 
-                adding = ", ".join([f"+{i}" for i in adding])
-                deleting = ", ".join([f"-{i}" for i in deleting])
-
-                self.__parent_profile.notify(self.__name,
-                                             f"{adding}, {deleting}" if adding and deleting else f"{adding}{deleting}")
+                self.__parent_profile.notify(self.__name, ", ".join(changes))
             elif initial_value is None and self._is_list(v):
                 adding = ", ".join([f"+{i}" for i in sorted(v.keys())])
 
@@ -350,5 +517,35 @@ class SignableAttribute(UserDict):
 
         return v
 
+    def _sign(self):
+        if _SIGNING_KEY is None:
+            raise RuntimeError("Unable to load signing key")
+
+        del self["signature"]
+        self["signature"] = {
+            "additional": [{
+                "alg": "RS256",
+                "name": None,
+                "typ": "JWS",
+                "value": "",
+            }],
+            "publisher": {
+                "alg": "RS256",
+                "name": environ["PUBLISHER_NAME"],
+                "typ": "JWS",
+                "value": jws.sign(self, _SIGNING_KEY, algorithm="RS256"),
+            }
+        }
+
+        self.__parent_profile._unsigned.pop(id(self), None)
+
+    def _release(self):
+        self.clear()
+        self.__name = None
+        self.__parent_profile = None
+
+        if len(_SIGNABLE_ATTRIBUTE_POOL) < _POOL_MAXSIZE:
+            _SIGNABLE_ATTRIBUTE_POOL.append(self)
+
     def _is_list(self, thingy) -> bool:
         return isinstance(thingy, dict) and not any(list(thingy.values()))
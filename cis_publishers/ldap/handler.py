@@ -1,20 +1,105 @@
 import boto3
 import concurrent.futures
-import json
+import hashlib
+import itertools
 import logging
+import lz4.frame
 import lzma
+import msgspec
+import orjson
 import time
+import zstandard
 
+from botocore.exceptions import BotoCoreError, ClientError
 from cis_publishers.common import InactiveProfileException, Profile, ProfileNotFoundException
-from inspect import cleandoc
+from cis_publishers.common.people import CONCURRENCY
 from os import environ
 from os.path import exists
+from textwrap import dedent
+from typing import Any, Dict, List, Optional, Union
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+# The LDAP dump is downloaded from S3 in up to this many concurrent byte ranges, each at least 8 MiB
+S3_DOWNLOAD_PARTS = 4
+S3_DOWNLOAD_MIN_PART_SIZE = 8 * 1024 * 1024
+
+# At most this many LDAP users are queued up in the thread pool at once
+MAX_IN_FLIGHT = 512
+
+# Fingerprints of what was last published for every LDAP user are thrown away after this many seconds,
+# so that every so often each profile is compared against CIS again, in case it was changed elsewhere
+FINGERPRINTS_MAX_AGE = 24 * 60 * 60
+
+# What gets returned when the LDAP dump can't be loaded
+_ERROR_500 = {
+    "statusCode": 500,
+    "body": orjson.dumps({
+        "error": "Invalid LDAP export",
+    }).decode("utf-8")
+}
+
+# What gets logged at the end of every run
+_RESULT_TEMPLATE = dedent("""\
+    LDAP Publisher results:
+
+      %d accounts synchronized.
+      %d accounts have CIS/HRIS/LDAP mismatches%s
+      %d accounts failed to synchronize%s
+
+    LDAP Publisher completed in %.2fs.""")
+
+# These are expensive to set up, so they're created once and then reused by warm Lambda invocations.
+# The thread pool (of 32 workers, by default) processes the LDAP user_ids; they spend nearly all of
+# their time waiting on the Person and Change APIs, and each has its own connection to them.
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENCY)
+_S3 = boto3.client("s3")
+
+# The last LDAP dump loaded from S3, which is reused across warm Lambda invocations until its ETag changes
+_LDAP_DUMP_CACHE = {
+    "bucket": None,
+    "data": None,
+    "etag": None,
+    "key": None,
+}
+
+
+class Posix(msgspec.Struct):
+    uid: Any = None
+    uid_number: Any = None
+
+
+class LdapProfile(msgspec.Struct):
+    """
+    A user's entry in the LDAP dump; only the fields that the LDAP publisher uses are decoded, the rest are skipped.
+
+    Every field may be missing or null, and fields that are only ever passed along (or logged) aren't checked at all.
+    Entries are decoded one at a time (see load_ldap_profile()), so an entry that still doesn't fit only fails that
+    one user, instead of keeping the whole dump from loading.
+    """
+    distinguished_name: Optional[str] = None
+    groups: Union[Dict[str, Any], List[Any], None] = None
+    pgp_public_keys: Optional[List[str]] = None
+    posix: Optional[Posix] = None
+    ssh_public_keys: Optional[List[str]] = None
+    user_id: Any = None
+
+    # These are only used by unused_create_profile()
+    created_at: Any = None
+    entry_uuid: Any = None
+    first_name: Any = None
+    last_name: Any = None
+    title: Any = None  # workday title, if they have it
+
+
+# The LDAP dump is decoded into the raw JSON of each user's entry, keyed by their primary email, and each
+# of those is then decoded into an LdapProfile by whoever needs it
+_LDAP_DUMP_DECODER = msgspec.json.Decoder(Dict[str, msgspec.Raw])
+_LDAP_PROFILE_DECODER = msgspec.json.Decoder(LdapProfile)
+
 
 def handle(event: dict, context=None) -> int:
     main()
@@ -22,70 +107,232 @@ def handle(event: dict, context=None) -> int:
     return None
 
 
-def get_ldap_dump(bucket: str = None, key: str = None, filename: str = None) -> dict:
+def get_ldap_dump(bucket: str = None, key: str = None, filename: str = None) -> Dict[str, msgspec.Raw]:
     """
     :param bucket: bucket name in S3
     :param key:  LDAP dump file name in S3
     :param filename: file name when running locally
-    :return: contents of compressed (or uncompressed) LDAP dump, as a dictionary
+    :return: contents of compressed (lz4, xz, or zst) or uncompressed LDAP dump, as a dictionary of raw entries
     """
     if bucket and key:
-        s3 = boto3.client("s3")
+        # The dump only changes every so often, so if it hasn't changed since the last (warm) invocation,
+        # we can skip downloading and parsing it all over again
+        head = _S3.head_object(Bucket=bucket,
+                               Key=key)
+        etag = head["ETag"]
+
+        if (_LDAP_DUMP_CACHE["bucket"], _LDAP_DUMP_CACHE["key"], _LDAP_DUMP_CACHE["etag"]) == (bucket, key, etag):
+            logger.info("Reusing cached LDAP data")
+
+            return _LDAP_DUMP_CACHE["data"]
 
         logger.info("Reloading LDAP data from S3")
 
-        s3object = s3.get_object(Bucket=bucket,
-                                 Key=key)["Body"]
+        # Pull the whole (compressed) object down before touching it, and hand the decompressor and the
+        # parser contiguous buffers, rather than having them read piecemeal from the network stream
+        body = download(_S3, bucket, key, etag, head["ContentLength"])
 
-        if environ["LDAP_CACHE_S3_KEY"].endswith("xz"):
-            with lzma.open(s3object) as __f:
-                return json.load(__f)
-        else:
-            return json.loads(s3object.read())
+        # Rebind body, so that the compressed dump can be freed before parsing begins
+        body = decompress(key, body)
+
+        _LDAP_DUMP_CACHE.update({
+            "bucket": bucket,
+            "data": _LDAP_DUMP_DECODER.decode(body),
+            "etag": etag,
+            "key": key,
+        })
+
+        return _LDAP_DUMP_CACHE["data"]
     elif filename:
         if not exists(filename):
             raise FileNotFoundError(f"Cannot open {filename}")
 
-        with open(filename, "r") as __f:
-            return json.load(__f)
+        with open(filename, "rb") as __f:
+            body = decompress(filename, __f.read())
+
+        return _LDAP_DUMP_DECODER.decode(body)
+
+
+def download(s3, bucket: str, key: str, etag: str, size: int) -> bytes:
+    """
+    Download an object from S3, as up to S3_DOWNLOAD_PARTS concurrent byte-range requests; every range is
+    pinned to the same ETag, so that we can't stitch together parts of two different LDAP dumps.
+
+    :param s3: boto3 S3 client
+    :param bucket: bucket name in S3
+    :param key: object name in S3
+    :param etag: ETag of the object (from a HEAD request)
+    :param size: size of the object, in bytes (also from a HEAD request)
+    :return: contents of the object
+    """
+    if size == 0:
+        return b""
+
+    # Objects too small to be worth splitting up are still fetched with a single request
+    parts = max(min(S3_DOWNLOAD_PARTS, size // S3_DOWNLOAD_MIN_PART_SIZE), 1)
+    part_size = -(-size // parts)
+
+    def get(start: int) -> bytes:
+        return s3.get_object(Bucket=bucket,
+                             IfMatch=etag,
+                             Key=key,
+                             Range=f"bytes={start}-{min(start + part_size, size) - 1}")["Body"].read()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parts) as executor:
+        return b"".join(executor.map(get, range(0, size, part_size)))
+
+
+def decompress(name: str, body: bytes) -> bytes:
+    """
+    :param name: file name (or S3 key) of the LDAP dump, whose extension says how it was compressed
+    :param body: contents of the LDAP dump
+    :return: the LDAP dump decompressed with LZ4, xz, or Zstandard, or as-is if it isn't compressed
+    """
+    if name.endswith("lz4"):
+        return lz4.frame.decompress(body)
+    elif name.endswith("xz"):
+        return lzma.decompress(body)
+    elif name.endswith("zst"):
+        # decompressobj(), as the dump may not have its decompressed size in its frame header
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+    return body
+
+
+def get_fingerprints(bucket: str, key: str) -> dict:
+    """
+    :param bucket: bucket name in S3
+    :param key: fingerprints file name in S3
+    :return: the fingerprints as stored by put_fingerprints(), or fresh ones if they're missing or too old
+    """
+    try:
+        fingerprints = orjson.loads(_S3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except (BotoCoreError, ClientError, orjson.JSONDecodeError):
+        # They're only there to save work, so without them, we simply compare every profile against CIS
+        logger.info("Unable to load fingerprints, synchronizing all LDAP users")
+        fingerprints = None
+
+    if not fingerprints or time.time() - fingerprints.get("created", 0) > FINGERPRINTS_MAX_AGE:
+        return {"created": time.time(), "fingerprints": {}}
+
+    return fingerprints
+
+
+def put_fingerprints(bucket: str, key: str, fingerprints: dict, emails) -> None:
+    """
+    :param bucket: bucket name in S3
+    :param key: fingerprints file name in S3
+    :param fingerprints: the fingerprints, as returned by get_fingerprints() and filled in by synchronize()
+    :param emails: primary emails of the users in the LDAP dump; everybody else's fingerprints are dropped
+    :return: None
+    """
+    fingerprints["fingerprints"] = {email: fingerprint for email, fingerprint in fingerprints["fingerprints"].items()
+                                    if email in emails}
+
+    _S3.put_object(Body=orjson.dumps(fingerprints),
+                   Bucket=bucket,
+                   Key=key)
+
+
+def fingerprint(payload: dict) -> str:
+    """
+    :param payload: the attributes that the LDAP publisher sets in CIS, from build_profile_payload()
+    :return: a digest of the payload, which is the same for the same attributes, regardless of their order
+    """
+    return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+
+def load_ldap_profile(entry: msgspec.Raw) -> LdapProfile:
+    """
+    :param entry: the raw JSON of a user's entry in the LDAP dump
+    :return: the entry, decoded; raises msgspec.ValidationError if it doesn't look like an LDAP user
+    """
+    return _LDAP_PROFILE_DECODER.decode(entry)
+
+
+def changed_users(ldap_users: Dict[str, msgspec.Raw], fingerprints: dict) -> dict:
+    """
+    :param ldap_users: contents of the LDAP dump
+    :param fingerprints: fingerprints of the LDAP users, as last published
+    :return: the fingerprints of the LDAP users that have changed since they were last published, by email;
+             users whose entries can't be decoded are always included (without a fingerprint)
+    """
+    # One pass over the whole dump, as parallel lists of emails and digests, before anything is handed
+    # to the thread pool; the payloads are thrown away, and only rebuilt for users that have changed
+    emails = list(ldap_users)
+    digests = []
+
+    for email, entry in ldap_users.items():
+        try:
+            digests.append(fingerprint(build_profile_payload(email, load_ldap_profile(entry))))
+        except msgspec.ValidationError:
+            digests.append(None)  # synchronize() will report it
+
+    previous = [fingerprints.get(email) for email in emails]
 
+    return {email: digest for email, digest, last in zip(emails, digests, previous)
+            if digest is None or digest != last}
 
-def synchronize(email, ldap_profile):
+
+def build_profile_payload(email: str, ldap_profile: LdapProfile) -> dict:
+    """
+    :param email: primary email of the LDAP user
+    :param ldap_profile: the user's entry in the LDAP dump
+    :return: the attributes that the LDAP publisher sets in CIS, laid out like a (simple) CIS profile
+    """
     # The mapping of LDAP field names to the ldap_profile key names can be found
     # in git-internal.mozilla.org/sysadmins/puppet/modules/ldap_crons/files/ldap_to_cis/ldap_to_cis.py
     # in the structure_output function
-    
-    # convenience variables to make referring to user profile data cleaner
-    dn = ldap_profile["distinguished_name"]
-    pgp_public_keys = {f"LDAP-{i}": f"0x{key}".replace(" ", "").replace("0x0x", "0x")
-                       for i, key in enumerate(ldap_profile.get("pgp_public_keys", []), start=1)}
-    phone_numbers = {f"LDAP-{i}": key.strip()
-                     for i, key in enumerate(ldap_profile.get("phone_numbers", []), start=1)}
-    ssh_public_keys = {f"LDAP-{i}": key.strip()
-                       for i, key in enumerate(ldap_profile.get("ssh_public_keys", []), start=1)}
-    user_id = ldap_profile["user_id"]
+    return {
+        "access_information": {
+            "ldap": ldap_profile.groups,
+        },
+        "identities": {
+            "mozilla_ldap_id": ldap_profile.distinguished_name,
+            "mozilla_ldap_primary_email": email,
+            "mozilla_posix_id": ldap_profile.posix.uid if ldap_profile.posix is not None else None,
+        },
+        "pgp_public_keys": {"LDAP-%d" % i: key if key.startswith("0x") else "0x" + key
+                            for i, key in enumerate((key.replace(" ", "")
+                                                     for key in ldap_profile.pgp_public_keys or ()), start=1)},
+        "ssh_public_keys": {"LDAP-%d" % i: key.strip()
+                            for i, key in enumerate(ldap_profile.ssh_public_keys or (), start=1)},
+    }
+
+
+def synchronize(email, entry):
+    try:
+        ldap_profile = load_ldap_profile(entry)
+    except msgspec.ValidationError as e:
+        logger.error("Unable to synchronize LDAP user with an invalid entry: %s (%s)", email, e)
+
+        return None
 
     # convenience variables to make the code below cleaner
+    dn = ldap_profile.distinguished_name
+
+    if dn is None:
+        logger.error("Unable to synchronize LDAP user without a distinguished name: %s", email)
+
+        return None
+
     display_level = "staff" if "o=com" in dn or "o=org" in dn else "private"
+    payload = build_profile_payload(email, ldap_profile)
+    user_id = ldap_profile.user_id
 
     # Update a profile
     try:
         # Note that this is a change from the previous
         p = Profile(email=email)
-        logger.debug(f"Updating user: {user_id} ({email})")
+        logger.debug("Updating user: %s (%s)", user_id, email)
 
         p.update({
-            "pgp_public_keys": pgp_public_keys,
-            "ssh_public_keys": ssh_public_keys,
+            "pgp_public_keys": payload["pgp_public_keys"],
+            "ssh_public_keys": payload["ssh_public_keys"],
         })
 
-        p["access_information"]["ldap"] = ldap_profile.get("groups")
-
-        p["identities"].update({
-            "mozilla_ldap_id": ldap_profile.get("distinguished_name"),
-            "mozilla_ldap_primary_email": email,
-            "mozilla_posix_id": ldap_profile.get("posix", {}).get("uid"),
-        })
+        p["access_information"].update(payload["access_information"])
+        p["identities"].update(payload["identities"])
 
     except InactiveProfileException:
         # scream and run away, since LDAP and HRIS are desynced - this should only happen when `active` is
@@ -122,9 +369,12 @@ def synchronize(email, ldap_profile):
         return False
 
     # Currently, only publish a changed profile
-    p.publish(display_level=display_level)
+    published = p.publish(display_level=display_level)
 
-    return True
+    # We're done with it, so its innards can be reused by the next profile
+    p.release()
+
+    return True if published else None
 
 
 def main():
@@ -138,55 +388,100 @@ def main():
             ldap_users = get_ldap_dump(filename=environ["LDAP_CACHE_FILENAME"])
         else:
             raise FileNotFoundError("No LDAP dump specified")
-    except:
-        return {
-            "statusCode": 500,
-            "body": json.dumps({
-                "error": "Invalid LDAP export",
-            })
-        }
-
-    # Create a thread pool of 32 workers to process the LDAP user_ids
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=32)
-    futures = []
+    # S3 errors, a missing file (or environmental variable), corrupt compression (lz4 raises RuntimeError),
+    # and invalid JSON, or JSON that isn't an object of LDAP entries (msgspec.ValidationError is a DecodeError)
+    except (BotoCoreError, ClientError, KeyError, OSError, RuntimeError, lzma.LZMAError, msgspec.DecodeError,
+            zstandard.ZstdError):
+        logger.exception("Unable to load LDAP dump")
 
-    for email, ldap_profile in ldap_users.items():
-        futures.append((email, executor.submit(synchronize, email, ldap_profile)))
+        return _ERROR_500
 
-    executor.shutdown(wait=True)
+    # Load the fingerprints of what the previous runs published, so that we can skip users that haven't changed
+    if environ.get("LDAP_CACHE_S3_BUCKET") and environ.get("LDAP_FINGERPRINTS_S3_KEY"):
+        last_run = get_fingerprints(bucket=environ["LDAP_CACHE_S3_BUCKET"], key=environ["LDAP_FINGERPRINTS_S3_KEY"])
+        fingerprints = last_run["fingerprints"]
+    else:
+        last_run = fingerprints = None
 
-    # Now we log whether everything went okay
     desynced_accounts = []
     failed_accounts = []
-    successful_accounts = []
+    successful_count = 0  # unlike the others, successful accounts are only counted, never listed
 
-    for future in futures:
-        result = future[1].result()
+    # Users that haven't changed since they were last published are already in sync with CIS
+    if fingerprints is not None:
+        changed = changed_users(ldap_users, fingerprints)
+        successful_count += len(ldap_users) - len(changed)
 
-        if result is True:
-            successful_accounts.append(future[0])
-        elif result is False:
-            desynced_accounts.append(future[0])
-        else:
-            failed_accounts.append(future[0])
+        # Until they have been published, we can't skip these users (even if LDAP goes back to what it was)
+        for email in changed:
+            fingerprints.pop(email, None)
+    else:
+        changed = ldap_users
 
-    desynced_accounts_list_msg = f": {', '.join(desynced_accounts)}" if desynced_accounts else ""
-    failed_accounts_list_msg = f": {', '.join(failed_accounts)}" if failed_accounts else ""
+    # Hand the LDAP user_ids to the thread pool, topping it back up as they finish, so that we never
+    # have more than MAX_IN_FLIGHT futures (and their arguments) waiting around at once
+    pending = iter(changed)
+    futures = {}
 
-    result_message = f"""
-        LDAP Publisher results:
-
-          {len(successful_accounts)} accounts synchronized.
-          {len(desynced_accounts)} accounts have CIS/HRIS/LDAP mismatches{desynced_accounts_list_msg}
-          {len(failed_accounts)} accounts failed to synchronize{failed_accounts_list_msg}
-
-        LDAP Publisher completed in {(time.time() - start_time):.2f}s.
-        """
-
-    logger.info(cleandoc(result_message))
-
-    # TODO: Once we're done logging, assuming that there were no failed accounts, we can finally store the
-    # status of this last run in S3 (or locally)
+    try:
+        while True:
+            for email in itertools.islice(pending, MAX_IN_FLIGHT - len(futures)):
+                futures[_EXECUTOR.submit(synchronize, email, ldap_users[email])] = email
+
+            if not futures:
+                break
+
+            # Now we log whether everything went okay, as each of them finishes
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                email = futures.pop(future)
+
+                # One user blowing up (or the Person or Change API falling over for them) is no reason to
+                # stop synchronizing everybody else
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.exception("Unexpected error synchronizing LDAP user: %s", email)
+                    result = None
+
+                if result is True:
+                    successful_count += 1
+
+                    if fingerprints is not None:
+                        fingerprints[email] = changed[email]
+                elif result is False:
+                    desynced_accounts.append(email)
+                else:
+                    failed_accounts.append(email)
+    finally:
+        # If we bail out early, don't leave anything queued in the (shared) thread pool to keep publishing on
+        # into the next warm invocation; whatever has already started gets to finish before we return
+        for future in futures:
+            future.cancel()
+
+        concurrent.futures.wait(futures)
+
+    # They finish in whatever order, so sort them to keep the results readable
+    desynced_accounts_list_msg = f": {', '.join(sorted(desynced_accounts))}" if desynced_accounts else ""
+    failed_accounts_list_msg = f": {', '.join(sorted(failed_accounts))}" if failed_accounts else ""
+
+    logger.info(_RESULT_TEMPLATE,
+                successful_count,
+                len(desynced_accounts), desynced_accounts_list_msg,
+                len(failed_accounts), failed_accounts_list_msg,
+                time.time() - start_time)
+
+    # Once we're done logging, we can finally store the status of this last run in S3; only the users that
+    # were published successfully have fingerprints, so everybody else will be tried again next time
+    if last_run is not None and environ.get("DRY_RUN") is None:
+        try:
+            put_fingerprints(bucket=environ["LDAP_CACHE_S3_BUCKET"],
+                             key=environ["LDAP_FINGERPRINTS_S3_KEY"],
+                             fingerprints=last_run,
+                             emails=ldap_users)
+        except (BotoCoreError, ClientError):
+            logger.warning("Unable to store fingerprints, all LDAP users will be synchronized next run")
 
 
 if __name__ == "__main__":